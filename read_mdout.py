@@ -1,46 +1,60 @@
 '''
 Parse an AMBER output file into a bunch of Numpy arrays.
 This currently assumes that fields do not appear or disappear during the course
-of MD.
+of MD. Requires Python 3.
 '''
 
-from __future__ import division, print_function
-
-
-import re, numpy
-from collections import deque
-from itertools import ifilter, imap
+import re, mmap, numpy
 
 class MDOutParser(object):
     '''Parses energies and related terms from AMBER mdout files. To use:
         parser = MDOutParser()
-        variables = parser.parse(open('mdout', 'rt'))
+        parser.parse(open('mdout', 'rb'))
+        variables = parser.time_series
     
-    The return value of ``parse()`` is a dictionary of Numpy arrays; if the run
-    completed successfully, then the last two entries (indices -2 and -1,
-    respectively) are the average value and RMS fluctuation over the run.
-    '''     
+    ``parse()`` fills ``simulation_params`` with the run's control parameters and
+    ``time_series`` with a Numpy array per quantity, one entry per step. If the
+    run completed successfully, the average value and RMS fluctuation of each
+    quantity are stored in ``time_series_averages`` and ``time_series_rmsds``
+    rather than at the end of the arrays. To process a long run without holding
+    all of it in memory, use ``iter_parse()``, which yields the time series in
+    chunks of at most ``chunksize`` steps instead of filling ``time_series``.
+    
+    ``default_type`` and the values of ``type_overrides`` (a dictionary keyed by
+    variable name) give the Numpy dtype of each time series; Python ``int``,
+    ``float``, and ``bool`` are accepted as shorthand (see ``dtype_map``). These
+    are used to cast the parsed values, not called on the value text, so
+    arbitrary converter functions are not supported.
     
+    The section header patterns (``re_new_section``, ``re_sim_params_begin``,
+    and ``re_time_series_begin``) are matched at the start of a line against
+    the raw bytes of the file, as are the literal ``sim_params_marker`` and
+    ``time_series_marker``. Subclasses may override them with either ``str``
+    or ``bytes``; ``str`` versions are encoded as Latin-1.
+    '''     
     
-    re_new_section       = re.compile(r'   \d+\.')
-    re_sim_params_begin  = re.compile(r'   \d+\.  CONTROL  DATA  FOR  THE  RUN')
-    re_time_series_begin = re.compile(r'   \d+\.  RESULTS')
-    re_is_float          = re.compile(r'\.|inf|nan', re.IGNORECASE)
-    re_is_bool           = re.compile(r'true|false',re.IGNORECASE)
-        
-    re_space_equals = re.compile(r'\s*=\s*')
-    re_split_line = re.compile(r'\s*,\s*|\s+')
     
-    # Split on any digit, absorbing whitespace, but only if that digit is
-    # not preceded by a '-' or a letter (i.e. is not the '4' in '1-4 NB' or 0 in 'TEMP0').
-    re_split_timeseries_line = re.compile(r'(?<=(?<!-|[A-Za-z])\d)\s*,?\s*',re.IGNORECASE)
+    re_new_section       = re.compile(br'   \d+\.')
+    re_sim_params_begin  = re.compile(br'   \d+\.  CONTROL  DATA  FOR  THE  RUN')
+    re_time_series_begin = re.compile(br'   \d+\.  RESULTS')
     
-    # Split about the equal sign
-    re_split_pair = re.compile(r'\s*=\s*')
+    # Literal text of the above section headers, for fast searching
+    sim_params_marker    = b'.  CONTROL  DATA  FOR  THE  RUN'
+    time_series_marker   = b'.  RESULTS'
+        
+    # Match one "key = value" pair; keys may contain anything but '=', ',' and
+    # newlines (e.g. '1-4 NB', 'TIME(PS)', 'EAMBER (non-restraint)', 'DV/DL'),
+    # but only start after whitespace or a comma, which keeps failed matches
+    # cheap. A pair never spans lines, since whole blocks are scanned at once.
+    re_kv = re.compile(r'(?<![^\s,])([^\s=,][^=,\n]*?)[ \t]*=[ \t]*([^\s,]+)')
     
-    initial_chunksize = 128
+    chunksize = 4096
     default_type = float
     type_overrides = {'NSTEP': int} 
+    
+    # Explicit Numpy dtypes for Python types, so that array dtypes do not
+    # depend on the platform; anything else is passed to Numpy as-is
+    dtype_map = {int: numpy.int64, float: numpy.float64, bool: numpy.bool_}
     block_start = ' NSTEP'
     
     def __init__(self, block_start=None, default_type=None, type_overrides=None):
@@ -48,81 +62,142 @@ class MDOutParser(object):
         self.default_type = default_type or self.__class__.default_type
         self.type_overrides = type_overrides if type_overrides else dict(self.__class__.type_overrides)
         
+        for attr in ('re_new_section', 're_sim_params_begin', 're_time_series_begin'):
+            regexp = getattr(self, attr)
+            if isinstance(regexp.pattern, str):
+                setattr(self, attr, re.compile(regexp.pattern.encode('latin-1'), regexp.flags & ~re.UNICODE))
+        for attr in ('sim_params_marker', 'time_series_marker'):
+            marker = getattr(self, attr)
+            if isinstance(marker, str):
+                setattr(self, attr, marker.encode('latin-1'))
+        
+        # Finds the next line starting with re_new_section
+        self._re_next_section = re.compile(b'\n(?:' + self.re_new_section.pattern + b')',
+                                           self.re_new_section.flags)
+        
+        dtype_map = self.dtype_map
+        for vtype in [self.default_type] + list(self.type_overrides.values()):
+            try:
+                numpy.dtype(dtype_map.get(vtype, vtype))
+            except TypeError:
+                raise TypeError('time series types must be Numpy dtypes, not {!r}'.format(vtype))
+        
         self.simulation_params = {}
         self.time_series = {}
         self.time_series_averages = {}
         self.time_series_rmsds = {}
         
-        self.mdout_file = None
-        self.line = None
-        
-    def _discard_until_matches(self, regexp):
-        mdout_file = self.mdout_file
-        line = self.line
-        while line and not regexp.match(line):
-            line = mdout_file.readline()
-        self.line = line
-        
-    def _parse_keyvalue_line(self, line):
-        re_space_equals = self.re_space_equals
-        re_split_line = self.re_split_line
-        
-        kvpairs = []
-        
-        if '=' in line:
-            line = re_space_equals.sub(' = ', line)
-            fields = deque(ifilter(None, imap(str.strip, re_split_line.split(line))))
-            while(fields):
-                key_fields = []
-                field = fields.popleft()
-                if field.startswith('('):
-                    # ignore rest of line
-                    break
-                while field != '=':
-                    key_fields.append(field)
-                    field = fields.popleft()
-                # discard equal
-                key_word = ' '.join(key_fields)
-                value_word = fields.popleft()
-                kvpairs.append((key_word,value_word))
-        return kvpairs
-    
+        self.mdout_data = None
+        self.pos = None
+        
+    def _discard_until_matches(self, regexp, marker=None):
+        data = self.mdout_data
+        pos = self.pos
+        end = len(data)
+        
+        if marker is not None:
+            # Jump straight to the lines containing ``marker`` instead of
+            # testing every line
+            found = data.find(marker, pos)
+            while found != -1:
+                linestart = data.rfind(b'\n', pos, found) + 1 or pos
+                if regexp.match(data, linestart):
+                    self.pos = linestart
+                    return
+                found = data.find(marker, found+1)
+        
+        while pos < end and not regexp.match(data, pos):
+            pos = data.find(b'\n', pos) + 1 or end
+        self.pos = pos
+        
+    def _find_section_end(self, pos):
+        '''Return the offset of the first section header following the line
+        that starts at ``pos``, or the end of the data if there is none.'''
+        data = self.mdout_data
+        eol = data.find(b'\n', pos)
+        if eol != -1:
+            match = self._re_next_section.search(data, eol)
+            if match:
+                return match.start() + 1
+        return len(data)
+        
     def _make_keyvalue_dict(self, pairs):
-        re_is_float = self.re_is_float
-        re_is_bool  = self.re_is_bool
         kvdict = {}
         for (key,valuetxt) in pairs:
-            if key.startswith('|'): continue
-            
-            if re_is_float.search(valuetxt):
-                value = float(valuetxt)
-            elif re_is_bool.match(valuetxt):
-                valuetxt = valuetxt.lower()
-                if valuetxt == 'true':
-                    value = True
-                else:
-                    value = False
-            else:
+            # The first character is enough to tell numbers (including inf/nan)
+            # from booleans and plain strings
+            c0 = valuetxt[:1]
+            if c0 in '+-.0123456789iInN':
                 try:
-                    value = int(valuetxt)
+                    if valuetxt.lstrip('+-').isdigit():
+                        value = int(valuetxt)
+                    else:
+                        value = float(valuetxt)
                 except ValueError:
                     value = valuetxt
+            elif c0 in 'tTfF' and valuetxt.lower() in ('true', 'false'):
+                value = c0 in 'tT'
+            else:
+                value = valuetxt
             kvdict[key] = value
         return kvdict
 
     def parse(self, mdout_file):
         '''Parse ``mdout_file``, populating the instance variables ``simulation_params``,
         ``time_series``, ``time_series_averages``, and ``time_series_rmsds`` (all
-        dictionaries) with results.
+        dictionaries) with results. If possible, ``mdout_file`` is memory-mapped
+        rather than read line by line.
         '''
         
-        self.mdout_file = mdout_file
-        self.line = mdout_file.readline()
-        self._discard_until_matches(self.re_sim_params_begin)
-        self._parse_sim_params()
-        self._discard_until_matches(self.re_time_series_begin)
-        self._parse_timeseries()
-        self.line = self.mdout_file = None
+        chunks = list(self.iter_parse(mdout_file))
+        variables = {}
+        if chunks:
+            for name in chunks[0]:
+                variables[name] = numpy.concatenate([chunk[name] for chunk in chunks])
+        self.time_series = variables
+        
+    def iter_parse(self, mdout_file):
+        '''Parse ``mdout_file`` like ``parse()``, but yield the time series in
+        chunks as it is parsed instead of storing it in ``time_series``. Each chunk
+        is a dictionary mapping variable names to arrays of at most ``chunksize``
+        values. ``simulation_params`` is populated before the first chunk is
+        yielded, and ``time_series_averages`` and ``time_series_rmsds`` after the
+        last.
+        '''
+        
+        try:
+            data = mmap.mmap(mdout_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, EnvironmentError, ValueError):
+            # Not a (non-empty) regular file; read it into memory instead
+            data = mdout_file.read()
+            if not isinstance(data, bytes):
+                data = data.encode('latin-1')
+                
+        self.mdout_data = data
+        self.pos = 0
+        try:
+            self._discard_until_matches(self.re_sim_params_begin, self.sim_params_marker)
+            self._parse_sim_params()
+            self._discard_until_matches(self.re_time_series_begin, self.time_series_marker)
+            for chunk in self._iter_timeseries():
+                yield chunk
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+            self.mdout_data = self.pos = None
+            
+    def _split_columns(self, colnames, matrix):
+        '''Split ``matrix`` (one row per block) into a dictionary of one
+        (contiguous) array per column, each of the appropriate dtype.'''
+        type_overrides = self.type_overrides
+        default_type = self.default_type
+        dtype_map = self.dtype_map
+        
+        columns = {}
+        for (icol, name) in enumerate(colnames):
+            vtype = type_overrides.get(name,default_type)
+            columns[name] = matrix[:, icol].astype(dtype_map.get(vtype, vtype))
+        return columns
         
 
     def _parse_sim_params(self):
@@ -161,25 +236,35 @@ Pressure regulation:
      pres0   =   1.00000, comp    =  44.60000, taup    =   5.00000
 '''
         
-        re_new_section = self.re_new_section
+        re_kv = self.re_kv
 
-        parse_keyvalue_line = self._parse_keyvalue_line
         make_keyvalue_dict = self._make_keyvalue_dict
         
         variables = self.simulation_params = {}
         
-        mdout_file = self.mdout_file
-        line = self.line
-        assert self.re_sim_params_begin.match(line)
-        line = mdout_file.readline()        
-        while line and not re_new_section.match(line):
-            line = mdout_file.readline()
-            if '=' in line:
-                variables.update(make_keyvalue_dict(parse_keyvalue_line(line)))
-        self.line = line
+        data = self.mdout_data
+        pos = self.pos
+        assert self.re_sim_params_begin.match(data, pos)
+        end = self._find_section_end(pos)
+        
+        # Skip the section header line
+        for line in data[pos:end].decode('latin-1').split('\n')[1:]:
+            if '=' not in line or line.startswith('|'):
+                continue
+            
+            pairs = []
+            for key, vtext in re_kv.findall(line):
+                key = key.strip()
+                if key.startswith('('):
+                    # ignore rest of line
+                    break
+                pairs.append((key, vtext))
+            variables.update(make_keyvalue_dict(pairs))
+        self.pos = end
     
-    def _parse_timeseries(self):
-        '''Parse time series of dynamical quantities'''
+    def _iter_timeseries(self):
+        '''Parse time series of dynamical quantities, yielding them in chunks of
+        at most ``chunksize`` blocks'''
         
         '''\
 
@@ -230,96 +315,208 @@ Pressure regulation:
 '''
 
         
-        type_overrides = self.type_overrides
-        default_type = self.default_type
+        chunksize = self.chunksize
         block_start = self.block_start
-        re_new_section = self.re_new_section
-        re_split_line = self.re_split_timeseries_line
-        re_split_pair = self.re_split_pair
         
-        variables = {}
-        nblocks = 0
-        
-        mdout_file = self.mdout_file
-        line = self.line
-        assert self.re_time_series_begin.match(line)
-        line = mdout_file.readline()        
-        while line and not re_new_section.match(line):
-            if line.startswith(block_start):
-                # beginning of a block
-                blockvars = {}                
-                while '=' in line:
-                    pairlist = re_split_line.split(line.strip())
-                    for pairtext in pairlist:
-                        key, vtext = re_split_pair.split(pairtext.strip())
-                        blockvars[key] = type_overrides.get(key,default_type)(vtext)
-                    line = mdout_file.readline()
+        # Bound methods used once or more per block
+        findall = self.re_kv.findall
+        
+        # Values are collected in a matrix with a row per block and a column per
+        # variable, in the order the variables appear in the first block. Two
+        # extra rows hold back the most recent blocks, which may turn out to be
+        # the average and RMS fluctuation rather than part of the time series.
+        colnames = None
+        matrix = None
+        nrows = 0
+        
+        # Variable name -> column index cache, so each name is looked up in
+        # colnames only once
+        keycols = {}
+        
+        data = self.mdout_data
+        pos = self.pos
+        assert self.re_time_series_begin.match(data, pos)
+        end = self._find_section_end(pos)
+        find = data.find
+        
+        block_marker = ('\n' + block_start).encode('latin-1')
+        pos = find(block_marker, pos, end)
+        while pos != -1:
+            # beginning of a block, which runs until the next ' ---' line (or
+            # the next block, if that comes first); only this slice is decoded
+            pos += 1
+            next_block = find(block_marker, pos, end)
+            limit = end if next_block == -1 else next_block
+            block_end = find(b'\n ---', pos, limit)
+            if block_end == -1:
+                if next_block == -1 and end == len(data):
+                    # Unterminated block at the very end of the file, as from a
+                    # run still in progress; its values may be incomplete
+                    break
+                block_end = limit
+                
+            pairs = findall(data[pos:block_end].decode('latin-1'))
 
-                if nblocks > 0:
-                    # Resize variables if necessary
-                    for name in variables:
-                        array = variables[name]
-                        if len(array) == nblocks:
-                            variables[name] = numpy.resize(array, (int(nblocks*1.5),))
-                            
-                    # Assign current value
-                    for key, value in blockvars.iteritems():
-                        variables[key][nblocks] = value
-                else:
-                    # Create arrays, one for each variable, and assign current value
-                    for key, value in blockvars.iteritems():
-                        variables[key] = numpy.empty((self.initial_chunksize,), dtype=type(value))
-                        variables[key][0] = value
-                nblocks += 1
-            else:
-                # Skip irrelevant line
-                line = mdout_file.readline()
+            if colnames is None:
+                # The first block determines the columns
+                colnames = []
+                for (name, _vtext) in pairs:
+                    if name not in colnames:
+                        colnames.append(name)
+                ncols = len(colnames)
+                matrix = numpy.empty((chunksize+2, ncols), dtype=numpy.float64)
+            elif nrows == len(matrix):
+                # Matrix is full; emit all but the two held-back rows
+                yield self._split_columns(colnames, matrix[:-2])
+                matrix[:2] = matrix[-2:]
+                nrows = 2
+            
+            rowvals = [None] * ncols
+            for (name, vtext) in pairs:
+                try:
+                    icol = keycols[name]
+                except KeyError:
+                    if name not in colnames:
+                        raise ValueError('time series block at byte {:d} has unexpected variable {!r}'
+                                         .format(pos, name))
+                    icol = keycols[name] = colnames.index(name)
+                rowvals[icol] = vtext
+            
+            if None in rowvals:
+                missing = [name for (name, vtext) in zip(colnames, rowvals) if vtext is None]
+                raise ValueError('time series block at byte {:d} is missing {}'
+                                 .format(pos, ', '.join(missing)))
+            
+            # Convert the text of the whole row in a single C-level pass; this is
+            # faster than having Numpy convert the strings one by one
+            matrix[nrows] = list(map(float, rowvals))
+            nrows += 1
+            
+            pos = next_block
         
-        # Trim output arrays to the appropriate length
-        for name in variables:
-            variables[name] = numpy.resize(variables[name], (nblocks,))
+        self.pos = end
+        self.time_series_averages = {}
+        self.time_series_rmsds = {}
+        if colnames is None:
+            return
         
         # Account for average and RMSD values
-        nstep = variables['NSTEP']
-        if (nstep[-3] == nstep[-2] == nstep[-1]):
-            for variable in variables:
-                data = variables[variable]
-                self.time_series_averages[variable] = data[-2]
-                self.time_series_rmsds[variable] = data[-1]
-                variables[variable] = numpy.resize(data, (len(data)-2,))  
+        nstep = matrix[:nrows, colnames.index('NSTEP')]
+        if nrows >= 3 and (nstep[-3] == nstep[-2] == nstep[-1]):
+            for (name, values) in self._split_columns(colnames, matrix[nrows-2:nrows]).items():
+                self.time_series_averages[name] = values[0]
+                self.time_series_rmsds[name] = values[1]
+            nrows -= 2
+        
+        if nrows:
+            yield self._split_columns(colnames, matrix[:nrows])
     
-        self.time_series = variables
-        self.line = line
+def parse_file(filename):
+    '''Parse the mdout file ``filename`` and return the ``MDOutParser`` holding
+    the results. Being a module-level function, this can be handed to a process
+    pool to parse many files at once.'''
+    parser = MDOutParser()
+    with open(filename, 'rb') as mdout_file:
+        parser.parse(mdout_file)
+    return parser
     
 if __name__ == '__main__':        
-    import argparse, h5py
+    import argparse, os, h5py
     parser = argparse.ArgumentParser(description='''\
 Parse AMBER mdout files into HDF5 files. Each quantity is stored in a data set
 identified by the label within the mdout file (e.g. "NSTEP", "EPtot", "Density", 
 "TIME(PS), and "EAMBER (non-restraint)"). In addition, average average values and RMS
-fluctuations are stored as attributes on each data set.''')
+fluctuations are stored as attributes on each data set. If more than one MDOUT is
+given, the files are parsed in parallel and the data from each is stored in a
+group named after that file's normalized path (with any leading "/" or ".."
+components removed).''')
     parser.add_argument('-o', '--output', default='mdout.h5',
                         help='''Store data in OUTPUT (default: %(default)s).''')
-    parser.add_argument('input', nargs='?', metavar='MDOUT', default='mdout', 
-                        help='Use MDOUT for input (default: %(default)s)')
+    parser.add_argument('--no-compress', dest='compress', action='store_false',
+                        help='''Store data sets uncompressed (default: compress with
+                        byte shuffling and LZF). Data sets are chunked and
+                        extensible either way, since they are written as the
+                        input is parsed.''')
+    parser.add_argument('input', nargs='*', metavar='MDOUT', default=['mdout'], 
+                        help='Use MDOUT for input (default: mdout)')
     
     args = parser.parse_args()
     
+    if len(args.input) > 1:
+        # Check group names before parsing anything or writing any output
+        group_names = []
+        for filename in args.input:
+            parts = os.path.normpath(filename).replace(os.sep, '/').split('/')
+            group_name = '/'.join(part for part in parts if part not in ('', '.', '..'))
+            if not group_name:
+                parser.error('cannot derive an HDF5 group name from {!r}'.format(filename))
+            if group_name in group_names:
+                parser.error('{!r} and {!r} would both be stored in group {!r}'
+                             .format(args.input[group_names.index(group_name)], filename, group_name))
+            group_names.append(group_name)
+    
     output_h5 = h5py.File(args.output, 'w')
-    input_file = open(args.input, 'rt')
-    parser = MDOutParser()
-    parser.parse(input_file)
+    if args.compress:
+        # Shuffling groups the slowly-varying high-order bytes of each value
+        # together, which LZF compresses well
+        dataset_opts = dict(compression='lzf', shuffle=True)
+    else:
+        dataset_opts = {}
     
-    attrs = output_h5.attrs
-    for (k,v) in parser.simulation_params.iteritems():
-        attrs[k] = v
+    def append_chunk(output_group, chunk):
+        '''Append each array in ``chunk`` to the like-named extensible data set in
+        ``output_group``, creating the data set if necessary. HDF5 chunks match
+        the parser's, so each parsed chunk fills exactly one of them.'''
+        for name, array in chunk.items():
+            if name in output_group:
+                output_ds = output_group[name]
+            else:
+                output_ds = output_group.create_dataset(name, shape=(0,), maxshape=(None,),
+                                                        dtype=array.dtype, chunks=(MDOutParser.chunksize,),
+                                                        **dataset_opts)
+            nvalues = len(output_ds)
+            output_ds.resize((nvalues+len(array),))
+            output_ds[nvalues:] = array
     
+    def write_attrs(output_group, parser):
+        attrs = output_group.attrs
+        for (k,v) in parser.simulation_params.items():
+            attrs[k] = v
+        
+        for name, value in parser.time_series_averages.items():
+            output_group[name].attrs['average'] = value
+        
+        for name, value in parser.time_series_rmsds.items():
+            output_group[name].attrs['rmsfluct'] = value
     
-    for name, array in parser.time_series.iteritems():
-        output_ds = output_h5.create_dataset(name, data=array)
+    if len(args.input) > 1:
+        from collections import deque
+        from concurrent.futures import ProcessPoolExecutor
         
-        if name in parser.time_series_averages:
-            output_ds.attrs['average'] = parser.time_series_averages[name]
+        def write_group(group_name, parser):
+            output_group = output_h5.create_group(group_name)
+            append_chunk(output_group, parser.time_series)
+            write_attrs(output_group, parser)
         
-        if name in parser.time_series_rmsds:
-            output_ds.attrs['rmsfluct'] = parser.time_series_rmsds[name]
+        # Parsing happens in worker processes; HDF5 output stays in this one.
+        # Only a couple of files per worker are in flight at once, so parsed
+        # results cannot pile up in memory if writing falls behind.
+        nworkers = os.cpu_count() or 1
+        with ProcessPoolExecutor(nworkers) as executor:
+            pending = deque()
+            for (group_name, filename) in zip(group_names, args.input):
+                pending.append((group_name, executor.submit(parse_file, filename)))
+                if len(pending) >= 2*nworkers:
+                    (group_name, future) = pending.popleft()
+                    write_group(group_name, future.result())
+            while pending:
+                (group_name, future) = pending.popleft()
+                write_group(group_name, future.result())
+    else:
+        # Stream the time series into the output as it is parsed, so that it
+        # never has to be held in memory all at once
+        parser = MDOutParser()
+        with open(args.input[0], 'rb') as mdout_file:
+            for chunk in parser.iter_parse(mdout_file):
+                append_chunk(output_h5, chunk)
+        write_attrs(output_h5, parser)